@@ -195,7 +195,7 @@ def main(args):
         
         # test
         model.eval() 
-        with torch.no_grad():
+        with torch.inference_mode():
             out = model(x, args.beta)
             preds = out['preds'].detach().cpu().numpy()
             label = x['label'].detach().cpu().numpy()
@@ -24,18 +24,22 @@ class AdjConstructor(nn.Module):
         emb1 = self.emb1(idx) 
         emb2 = self.emb2(idx) 
 
-        emb1 = torch.tanh(self.alpha * self.theta1(emb1))
-        emb2 = torch.tanh(self.alpha * self.theta2(emb2))
-
-        adj_mat = torch.relu(torch.tanh(self.alpha*(emb1@emb2.T - emb2@emb1.T))) # adjacency matrix
-        mask = torch.zeros(idx.size(0), idx.size(0)).to(idx.device) 
-        mask.fill_(float('0'))
+        # the scores are computed in bf16 (on gpus supporting it): top_k may pick different entries when scores are nearly equal
+        with torch.autocast(idx.device.type, dtype= torch.bfloat16, 
+                            enabled= idx.is_cuda and torch.cuda.is_bf16_supported()):
+            emb1 = torch.tanh(self.alpha * self.theta1(emb1))
+            emb2 = torch.tanh(self.alpha * self.theta2(emb2))
+            scores = emb1 @ emb2.transpose(-1, -2)
+            scores = scores - scores.transpose(-1, -2) # emb1@emb2.T - emb2@emb1.T
+
+        adj_mat = torch.relu(torch.tanh(self.alpha*scores.float())) # adjacency matrix
+        # only the indices are used (in any order)
         if self.training:
-            s1, t1 = (adj_mat + torch.rand_like(adj_mat)*0.01).topk(self.top_k, 1) # values, indices
+            _, t1 = (adj_mat + torch.rand_like(adj_mat)*0.01).topk(self.top_k, 1, sorted= False) # values, indices
         else: 
-            s1, t1 = adj_mat.topk(self.top_k, 1)
-        mask.scatter_(1, t1, s1.fill_(1))
-        adj_mat = adj_mat * mask 
+            _, t1 = adj_mat.topk(self.top_k, 1, sorted= False)
+        # keep the top_k scores of every row, zeros elsewhere
+        adj_mat = torch.zeros_like(adj_mat).scatter_(1, t1, adj_mat.gather(1, t1))
         return adj_mat
 
 def encode_onehot(labels): 
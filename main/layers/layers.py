@@ -2,7 +2,7 @@ import torch
 from torch import nn 
 from torch.nn import functional as F
 
-def make_input_n_mask_pairs(x, device): 
+def make_input_n_mask_pairs(x): 
     r"""A fucntion to make pairs of input-mask
 
     # Arguments
@@ -22,11 +22,21 @@ def make_input_n_mask_pairs(x, device):
             n= # time-series of the x['input']                           
     """
     b, c, n, p =  x['input'].shape # batch_size, #channel, #time-series, #time-stamps
-    pair = torch.zeros((b,2*c,n,p)).to(device)
-    pair[:, ::2, ...] = x['input'] 
-    pair[:, 1::2, ...] = x['mask']
+    # interleave along the channel: input, mask, input, mask, ...
+    pair = torch.stack((x['input'], x['mask']), dim= 2).reshape(b, 2*c, n, p)
     return pair
 
+def cuda_graph_capturing(): 
+    r"""True while a CUDA graph is being captured on the current stream
+    """
+    return torch.cuda.is_available() and torch.cuda.is_current_stream_capturing()
+
+@torch.jit.script
+def gated_tanh_sigmoid(x_filter, x_gate): 
+    r"""Gated activation: tanh(x_filter) * sigmoid(x_gate) in a single fused kernel
+    """
+    return torch.tanh(x_filter) * torch.sigmoid(x_gate)
+
 class ResidualAdd(nn.Module):
     r"""Residual connection
 
@@ -45,8 +55,8 @@ class ResidualAdd(nn.Module):
     def forward(self, x, **kwargs):
         res = x
         x = self.fn(x, **kwargs)
-        x += res
-        return x
+        # out-of-place: fn may return its input (or a view of it), which must not be modified
+        return x + res
 
 # projection layer
 class ProjectionConv1x1Layer(nn.Module): 
@@ -66,8 +76,18 @@ class ProjectionConv1x1Layer(nn.Module):
         pair : torch-Tensor
             generated by the function: make_input_n_mask_pairs(x)
             the shape of the tensor 'pair' is b, 2*c, t, n 
+        
+        the grouped conv1x1 is computed as a batched matmul over the groups
         """
-        return self.projection(pair)
+        conv, drop = self.projection
+        b, _, t, n = pair.shape
+        g = conv.groups
+        weight = conv.weight.reshape(g, -1, self.in_channels//g) # g, out/g, in/g
+        h = torch.matmul(weight, pair.reshape(b, g, self.in_channels//g, t*n)) # b, g, out/g, t*n
+        h = h.reshape(b, self.out_channels, t, n)
+        if conv.bias is not None: 
+            h = h + conv.bias.reshape(1, -1, 1, 1)
+        return drop(h)
 
 class CausalDilatedVerticalConv1d(nn.Module): 
     r"""Causal dilated convoltion
@@ -189,18 +209,51 @@ class DilatedInceptionLayer(nn.Module):
         self.branch3x1 = MultiVariateCausalDilatedLayer(in_channels, out_channels, (3,1), in_channels, 1, num_time_series, **kwargs)
         self.branch5x1 = MultiVariateCausalDilatedLayer(in_channels, out_channels, (3,1), in_channels, 2, num_time_series, **kwargs)
         self.branch7x1 = MultiVariateCausalDilatedLayer(in_channels, out_channels, (3,1), in_channels, 3, num_time_series, **kwargs)
+        self.drop = nn.Dropout2d(0.2)
 
         self.in_channels, self.out_channels = in_channels, out_channels
+        self.groups = in_channels
+        self.receptive_field = 7 # the largest branch: (3,1) kernel with dilation 3
 
-    def forward(self, x): 
-        b, c, n, p = x.shape
-        outs = torch.zeros(b, 4*c, n, p).to(x.device)
+        # position of every tap of the branches in the fused (branch, receptive_field) kernel: 
+        # every kernel is placed at the end of the receptive field with its taps spread by its dilation.
+        taps = []
         for i in range(4): 
-            branch = getattr(self, f'branch{2*i+1}x1')
-            outs[:, i::4, ...] = branch(x) 
-            # we have c groups of receptive channels...
-            # = 4 channels form one group.
-        return outs
+            conv = getattr(self, f'branch{2*i+1}x1').causal_conv.causal_conv
+            k, d = conv.kernel_size[0], conv.dilation[0]
+            taps += [(i+1)*self.receptive_field - 1 - (k-1-j)*d for j in range(k)]
+        self.register_buffer('taps', torch.LongTensor(taps), persistent= False)
+
+    def fused_kernel(self):
+        r"""Stacks the kernels of the four branches into one dense causal kernel
+
+        the taps of the branches are scattered into a (receptive_field, 1) kernel by one index_copy.
+        the output channels are ordered as (group, branch, channel) so that
+        a single grouped convolution computes all four branches.
+        """
+        convs = [getattr(self, f'branch{2*i+1}x1').causal_conv.causal_conv for i in range(4)]
+        o, i_g = convs[0].weight.shape[:2]
+        taps = torch.cat([conv.weight.flatten(2) for conv in convs], dim= -1) # o, i_g, #taps
+        weight = taps.new_zeros((o, i_g, 4*self.receptive_field)).index_copy(-1, self.taps, taps)
+        weight = weight.reshape(self.groups, o//self.groups, i_g, 4, self.receptive_field).permute(0, 3, 1, 2, 4)
+        weight = weight.reshape(-1, i_g, self.receptive_field, 1)
+        bias = torch.stack([conv.bias.reshape(self.groups, -1) for conv in convs], dim= 1).flatten()\
+            if convs[0].bias is not None else None
+        return weight, bias
+
+    def forward(self, x):
+        b, c, n, p = x.shape
+        weight, bias = self.fused_kernel()
+        h = self.branch1x1.ravel(x) # b, c*p, n, 1
+        h = F.pad(h, (0, 0, self.receptive_field-1, 0)) # causal padding
+        h = self.drop(F.conv2d(h, weight, bias, groups= self.groups)) # b, groups*4*(c*p/groups), n, 1
+        # unravel every branch and interleave them:
+        # we have c groups of receptive channels...
+        # = 4 channels form one group.
+        h = h.reshape(b, self.groups, 4, -1, n).transpose(1, 2) # b, 4, c*p, n
+        h = h.reshape(b, 4, c*p, n).transpose(-1, -2).reshape(b, 4, c, n, p)
+        # the interleaving copy is written in channels_last for the conv_inter of the TemporalConvolutionModule
+        return h.permute(0, 3, 4, 2, 1).reshape(b, n, p, 4*c).permute(0, 3, 1, 2)
     
 class TemporalConvolutionModule(nn.Module): 
     r"""TemporalConvolutionModule
@@ -210,13 +263,12 @@ class TemporalConvolutionModule(nn.Module):
         self.dil_filter = DilatedInceptionLayer(in_channels, out_channels, num_time_series, **kwargs)
         self.dil_gate = DilatedInceptionLayer(in_channels, out_channels, num_time_series, **kwargs) 
         self.conv_inter = nn.Conv2d(4*in_channels, in_channels, 1, groups= num_heteros, **kwargs)
+        self.conv_inter = self.conv_inter.to(memory_format= torch.channels_last)
         self.in_channels, self.out_channels = in_channels, out_channels  
         self.num_heteros = num_heteros
 
     def forward(self, x): 
-        out_filter = torch.tanh(self.dil_filter(x))
-        out_gate = torch.sigmoid(self.dil_gate(x)) 
-        out = out_filter*out_gate
+        out = gated_tanh_sigmoid(self.dil_filter(x), self.dil_gate(x))
         return self.conv_inter(out)        
 
 # graph convolution layer 
@@ -278,31 +330,45 @@ class GraphConvolutionModule(nn.Module):
         super().__init__() 
         # self.conv_inter = nn.Conv2d(in_features, out_features, 1, groups= out_features, **kwargs)
 
-        for i in range(1, k+1):
-            setattr(self, f'gcl{i}', InformationPropagtionLayer())
-
-        for i in range(k+1): 
-            setattr(self, f'info_select{i}', nn.Conv2d(out_features, out_features, 1,1,0,1, groups= out_features, bias= False, **kwargs))
+        self.gcls = nn.ModuleList([InformationPropagtionLayer() for _ in range(k)])
+        # info_select of every layer (hop): a depth-wise conv1x1 per hop, 
+        # fused into one grouped conv1x1 on the hiddens interleaved per channel
+        self.info_select_all = nn.Conv2d((k+1)*out_features, out_features, 1,1,0,1, groups= out_features, bias= False, **kwargs)
+        self.info_select_all = self.info_select_all.to(memory_format= torch.channels_last)
+        # same initialization as a depth-wise conv1x1 per hop (fan_in= 1): uniform on [-1, 1]
+        nn.init.uniform_(self.info_select_all.weight, -1., 1.)
         
         self.in_features, self.out_features, self.k\
             = in_features, out_features, k
     
     def forward(self, x, A, beta= 0.5):
-        A_tilde = A # assumes the matrix 'A' is normalized...
-        A_tilde_after = A_tilde
+        # assumes the matrix 'A' is normalized... (or a list of its powers given by adj_powers)
+        A_tildes = A if isinstance(A, list) else self.adj_powers(A)
         # x = self.conv_inter(x)
         hiddens = [x]
-        gcl = getattr(self, 'gcl1')
-        hiddens.append(gcl(hiddens[-1], x, A_tilde))
-        for i in range(2, self.k+1): 
-            gcl = getattr(self, f'gcl{i}')
-            A_tilde_after = torch.matmul(torch.transpose(A_tilde_after,-1,-2), A_tilde)
-            hiddens.append(gcl(hiddens[-1], x, A_tilde_after, beta= beta))
-        out = 0
-        for i in range(self.k+1):
-            info_select = getattr(self, f'info_select{i}')
-            out += info_select(hiddens[i])
-        return out 
+        hiddens.append(self.gcls[0](hiddens[-1], x, A_tildes[0]))
+        for i in range(1, self.k): 
+            hiddens.append(self.gcls[i](hiddens[-1], x, A_tildes[i], beta= beta))
+        # interleaved in channels_last: bs, t, n, c*(k+1) --> bs, c*(k+1), t, n
+        h = torch.stack([hidden.permute(0, 2, 3, 1) for hidden in hiddens], dim= -1).flatten(-2).permute(0, 3, 1, 2)
+        return self.info_select_all(h)
+
+    def adj_powers(self, A): 
+        r"""Obtains the adjacency matrices of every layer (hop) 
+        A, A^T @ A, (A^T @ A)^T @ A, ...
+        """
+        A_tildes = [A]
+        for _ in range(2, self.k+1): 
+            A_tildes.append(torch.matmul(torch.transpose(A_tildes[-1],-1,-2), A))
+        return A_tildes
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs): 
+        # older checkpoints hold a depth-wise conv1x1 per hop: 
+        # info_select{i}.weight --> info_select_all.weight[:, i]
+        keys = [f'{prefix}info_select{i}.weight' for i in range(self.k+1)]
+        if all(key in state_dict for key in keys): 
+            state_dict[f'{prefix}info_select_all.weight'] = torch.cat([state_dict.pop(key) for key in keys], dim= 1)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
 class HeteroBlock(nn.Module):
     r"""Hetero block 
@@ -329,6 +395,9 @@ class HeteroBlock(nn.Module):
         self.tc_module = TemporalConvolutionModule(num_heteros, num_heteros, num_heteros, num_time_series, **kwargs)
         self.gc_module = GraphConvolutionModule(num_heteros, num_heteros, k=k, **kwargs)
         # self.gc_module_t = GraphConvolutionModule(num_heteros, num_heteros, k=k, **kwargs)
+        # identity matrix for the self-loops of norm_adj (broadcasts over the hetero groups)
+        self.register_buffer('eye', torch.eye(num_time_series), persistent= False)
+        self._adj_cache = None # (key, A, powers of the normalized A)
 
         self.num_heteros = num_heteros
         self.k = k 
@@ -347,26 +416,42 @@ class HeteroBlock(nn.Module):
         A : torch-tensor           
             Adjacency matrix        
         """
-        A_tilde = self.norm_adj(A)
+        A_tildes = self.adj_powers(A)
         res = x 
         out_tc = self.tc_module(x) 
-        x = self.gc_module(out_tc, A_tilde, beta= beta)
+        x = self.gc_module(out_tc, A_tildes, beta= beta)
         # x += self.gc_module_t(out_tc, torch.transpose(A, -1, -2), beta= beta)
         return out_tc, F.leaky_relu(x+res,negative_slope=0.5)
 
+    def adj_powers(self, A): 
+        r"""Obtains the powers of the normalized adjacency matrix for every layer (hop) of the gc_module
+        They are cached while the same graph is fed without gradients 
+        (e.g., evaluation of the MTGNN, whose graph only depends on its parameters).
+        They are recomputed while capturing a CUDA graph, so that the graph does not 
+        read cached tensors which are freed once the cache is cleared.
+        """
+        if self.training or torch.is_grad_enabled() or cuda_graph_capturing(): 
+            self._adj_cache = None
+            return self.gc_module.adj_powers(self.norm_adj(A))
+        key = (A.data_ptr(), A.shape, A.device, None if A.is_inference() else A._version)
+        if self._adj_cache is None or self._adj_cache[0] != key: 
+            # holds 'A' so that its memory (data_ptr) is not reused by another graph
+            self._adj_cache = (key, A, self.gc_module.adj_powers(self.norm_adj(A)))
+        return self._adj_cache[2]
+
     def norm_adj(self, A): 
         r"""Obtains normalized version of an adjacency matrix
         """
         if len(A.shape) == 3 or len(A.shape) == 2:
+            # no_grad rather than inference_mode: A_tilde is saved for backward by the gc_module 
             with torch.no_grad():
+                # D_tilde_inv @ (A + I) == (A + I) scaled row-wise by the diagonal of D_tilde_inv
                 if len(A.shape) == 3: 
-                    eyes = torch.stack([torch.eye(A.shape[1]) for _ in range(A.shape[0])]).to(device= A.device)
-                    D_tilde_inv = torch.diag_embed(1/(1. + torch.sum(A, dim=1))) # C x N x N 
-                    A_tilde = D_tilde_inv @ (A + eyes)
+                    d_tilde_inv = 1/(1. + torch.sum(A, dim=1, keepdim=True)) # C x 1 x N 
+                    A_tilde = (A + self.eye) * d_tilde_inv.transpose(-1, -2)
                 else: 
-                    eye = torch.eye(A.shape[1]).to(A.device)
-                    D_tilde_inv = torch.diag(1/(1.+torch.sum(A, dim=1)))
-                    A_tilde = D_tilde_inv @ (A + eye)
+                    d_tilde_inv = 1/(1.+torch.sum(A, dim=1, keepdim=True)) # N x 1
+                    A_tilde = (A + self.eye) * d_tilde_inv
             return A_tilde 
         else: 
             # shape of A is [bs, c, n, n]
@@ -63,6 +63,7 @@ class MTGNN(nn.Module):
         # hetero adjacency matrices
         self.ts_idx = torch.LongTensor(list(range(num_ts))).to(device) # to device...
         self.gen_adj = nn.ModuleList([AdjConstructor(num_ts, embedding_dim, alpha, top_k= top_k) for _ in range(num_heteros)])
+        self._adj_cache = None # (key, A)
     
         # output_module
         # self.fc_out = nn.Conv2d(num_heteros, num_heteros, (1, time_lags), padding= 0)
@@ -102,12 +103,12 @@ class MTGNN(nn.Module):
         r"""Feed forward of the model 
         Assume, x is a pair of x['input'] and x['mask']
         """
-        # x_batch = make_input_n_mask_pairs(x, self.device)
+        # x_batch = make_input_n_mask_pairs(x)
         x_batch, mask_batch = x['input'], x['mask']
         x_batch = self.projection(x_batch) # bs, c (=num_heteros), t, n 
         bs, c, t, n = x_batch.shape
-        A = torch.stack([gll(self.ts_idx) for gll in self.gen_adj]).to(self.device) # c, n, n 
-        outs_label = torch.zeros((bs, c * (self.num_blocks+2), t, n)).to(self.device) # to collect outputs from modules
+        A = self.adj_mats() # c, n, n 
+        outs_label = torch.zeros((bs, c * (self.num_blocks+2), t, n), device= self.device) # to collect outputs from modules
         out = x_batch.clone().detach()
         outs_label[:, ::(self.num_blocks+2), ...] = out
         for i in range(self.num_blocks): 
@@ -133,6 +134,20 @@ class MTGNN(nn.Module):
             'adj_mat': None
         }
 
+    def adj_mats(self): 
+        r"""Hetero adjacency matrices (c x n x n)
+        They only depend on the parameters of gen_adj, 
+        so they are cached while evaluated without gradients until the parameters change.
+        They are recomputed while capturing a CUDA graph (see HeteroBlock.adj_powers).
+        """
+        if self.training or torch.is_grad_enabled() or cuda_graph_capturing(): 
+            self._adj_cache = None
+            return torch.stack([gll(self.ts_idx) for gll in self.gen_adj]).to(self.device)
+        key = tuple((p.data_ptr(), p._version) for p in self.gen_adj.parameters())
+        if self._adj_cache is None or self._adj_cache[0] != key: 
+            self._adj_cache = (key, torch.stack([gll(self.ts_idx) for gll in self.gen_adj]).to(self.device))
+        return self._adj_cache[1]
+
 def gumbel_softmax(logits, tau, hard= True, dim= 1):
     r"""
     returns a continuous approximation of the discrete distribution 
@@ -345,7 +360,7 @@ class HeteroNRI(nn.Module):
         x_batch = self.projection(x_batch) 
         bs, c, t, n = x_batch.shape 
 
-        outs_label = torch.zeros((bs, c * (self.num_blocks+2), t, n)).to(self.device) # to collect outputs from modules
+        outs_label = torch.zeros((bs, c * (self.num_blocks+2), t, n), device= self.device) # to collect outputs from modules
         out = x_batch.clone().detach()
         outs_label[:, ::(self.num_blocks+2), ...] = out
         for i in range(self.num_blocks): 
@@ -563,7 +578,7 @@ class HeteroSpatialNRI(nn.Module):
         x_batch = self.projection(x_batch) 
         bs, c, t, n = x_batch.shape 
 
-        outs_label = torch.zeros((bs, c * (self.num_blocks+2), t, n)).to(self.device) # to collect outputs from modules
+        outs_label = torch.zeros((bs, c * (self.num_blocks+2), t, n), device= self.device) # to collect outputs from modules
         out = x_batch.clone().detach()
         outs_label[:, ::(self.num_blocks+2), ...] = out
         for i in range(self.num_blocks): 